@@ -0,0 +1,48 @@
+"""
+会话表内存基准，输出 10k/100k/1M 个会话时每个会话占用的字节数
+
+    python benchmarks/bench_session_memory.py [N ...]
+"""
+import gc
+import sys
+import tracemalloc
+import uuid
+
+import nonebot
+
+nonebot.init()
+nonebot.load_plugin("nonebot_plugin_dify")
+
+from nonebot_plugin_dify.dify_session import DifySession, DifySessionManager  # noqa: E402
+
+
+def measure(n: int) -> float:
+    # 预先生成conversation_id，只统计会话表本身的内存
+    conversation_ids = [str(uuid.uuid4()) for _ in range(n)]
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+
+    manager = DifySessionManager(DifySession)
+    for i in range(n):
+        # 与消息处理中相同，每条消息都会重新拼接user字符串
+        session = manager.get_session(f"onebot v11-{1000000000 + i}")
+        session.set_conversation_id(conversation_ids[i])
+        session.count_user_message()
+
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(manager) == n
+    return (after - before) / n
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+    print(f"{'sessions':>10} {'bytes/session':>14}")
+    for n in sizes:
+        print(f"{n:>10} {measure(n):>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
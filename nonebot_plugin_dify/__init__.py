@@ -1,10 +1,16 @@
-from nonebot.adapters import Bot, Event
-from nonebot import require, on_command, on_message, logger
+from nonebot.adapters import Bot, Event, Message
+from nonebot import require, on_command, on_message, get_driver
+from nonebot.params import Command, CommandArg
 from nonebot.internal.matcher.matcher import Matcher
 from nonebot.plugin import PluginMetadata, inherit_supported_adapters
-from nonebot.rule import Rule, to_me
+from nonebot.permission import SUPERUSER
+from nonebot.rule import Rule
 from nonebot.typing import T_State
+import asyncio
 import os
+import shutil
+import time
+from typing import Optional
 
 require("nonebot_plugin_localstore")
 require("nonebot_plugin_alconna")
@@ -12,12 +18,20 @@ from nonebot_plugin_alconna import Image, At, UniMessage, image_fetch
 import nonebot_plugin_localstore as store
 from .config import Config, config
 from .dify_bot import DifyBot
-from .common.reply_type import ReplyType
+from .dify_parameters import app_parameters
+from .dify_jobs import job_queue, submit_message_feedback
 from .common import memory
-from .common.utils import get_pic_from_url, save_pic
+from .common.delivery import ReplyDelivery, get_adapter_limits
+from .common.dedup import EventDeduplicator
+from .common.metrics import metrics
+from .common.trigger import TriggerEngine, TriggerDecision, get_group_id
+from .common.trace import logger, trace, span
+from .common.profiler import profiler
+from .common.deadline import DeadlineExceeded, deadline, remaining, stage_latency, stage_timeout
 
 
 dify_bot = DifyBot()
+driver = get_driver()
 
 __version__ = "0.1.4"
 
@@ -37,89 +51,259 @@ __plugin_meta__ = PluginMetadata(
 )
 
 
-async def ignore_rule(event: Event) -> bool:
-    msg = event.get_plaintext().strip()
+def get_download_dir() -> str:
+    """回复中图片、视频、文件的临时下载目录"""
+    return os.path.join(store.get_cache_dir("nonebot_plugin_dify"), "download")
 
-    # 消息以忽略词开头
-    if next(
-        (x for x in config.dify_ignore_prefix if msg.startswith(x)),
-        None,
-    ):
-        return False
 
-    # at 始终触发
-    if event.is_tome():
-        return True
+@driver.on_startup
+async def _():
+    # 清理上次运行遗留的临时下载文件
+    await asyncio.to_thread(shutil.rmtree, get_download_dir(), True)
+    cache_dir = store.get_cache_dir("nonebot_plugin_dify")
+    await memory.IMAGE_CACHE.start(
+        os.path.join(cache_dir, config.dify_image_cache_dir), config.dify_image_cache_sweep_interval
+    )
+    await app_parameters.start()
+    await job_queue.start(os.path.join(store.get_data_dir("nonebot_plugin_dify"), "pending_jobs.json"))
+
+
+@driver.on_shutdown
+async def _():
+    await app_parameters.stop()
+    await job_queue.stop()
+    await memory.IMAGE_CACHE.stop()
+
+
+event_dedup = EventDeduplicator(config.dify_dedup_window, config.dify_dedup_max_size)
+
+trigger_engine = TriggerEngine(
+    ignore_prefix=config.dify_ignore_prefix,
+    trigger_prefix=config.dify_trigger_prefix,
+    block_keywords=config.dify_block_keywords,
+    group_whitelist=config.dify_group_whitelist,
+    group_blacklist=config.dify_group_blacklist,
+)
+
+
+def get_target_group_id(bot: Bot, event: Event) -> Optional[str]:
+    """
+    事件没有常见的群号字段时通过alconna的target获取，私聊返回None，无法判断时返回空字符串
+    """
+    try:
+        target = UniMessage.get_target(event=event, bot=bot)
+    except Exception:
+        return ""
+    if target.private:
+        return None
+    return str(target.id or "")
 
-    return False
+
+async def trigger_rule(bot: Bot, event: Event, state: T_State) -> bool:
+    group_id = get_group_id(event)
+    # 只有配置了群名单时才需要准确的群号，此时才获取target
+    if group_id is None and trigger_engine.has_group_filter:
+        group_id = get_target_group_id(bot, event)
+    decision, query = trigger_engine.decide(event.get_plaintext().strip(), event.is_tome(), group_id)
+
+    # 没有文本的消息只在需要缓存图片时处理
+    if decision == TriggerDecision.IMAGE_ONLY and not app_parameters.can_upload_image():
+        return False
+    if decision == TriggerDecision.SKIP:
+        return False
+
+    state["dify_decision"] = decision
+    state["dify_query"] = query
+    return True
 
 recieve_message: type[Matcher] = on_message(
-        rule=Rule(ignore_rule) & to_me(),
+        rule=Rule(trigger_rule),
         priority=99,
         block=False,
     )
 
 
+def get_adapter_name(target) -> str:
+    if target.adapter:
+        return target.adapter.replace("SupportAdapter.","").lower()
+    return "default"
+
+
+def get_dedup_key(bot: Bot, event: Event) -> Optional[str]:
+    try:
+        message_id = UniMessage.get_message_id(event=event, bot=bot)
+    except Exception:
+        message_id = getattr(event, "message_id", None)
+    if not message_id:
+        return None
+    return f"{bot.adapter.get_name()}-{bot.self_id}-{message_id}"
+
+
+async def cache_image(bot: Bot, event: Event, state: T_State, adapter_name: str, session_id: str):
+    _msg = UniMessage.generate_without_reply(event=event, bot=bot)
+    if not _msg.has(Image):
+        return
+    imgs = _msg[Image]
+    _img = imgs[0]
+    try:
+        start_time = time.perf_counter()
+        _img_bytes = await asyncio.wait_for(
+            image_fetch(event=event, bot=bot, state=state, img=_img),
+            stage_timeout("image_fetch", 20),
+        )
+        # 超时不计入，避免拉低自适应超时的样本
+        stage_latency.observe("image_fetch", time.perf_counter() - start_time)
+    except (DeadlineExceeded, asyncio.TimeoutError):
+        logger.warning("Fetching image {} from {} timed out.", _img.id, adapter_name)
+        return
+    _reject_reason = app_parameters.check_image(len(_img_bytes), _img.id or "", _img.mimetype) if _img_bytes else None
+    if _reject_reason:
+        logger.warning("Ignored image {} from {}: {}.", _img.id, adapter_name, _reject_reason)
+    elif _img_bytes:
+        logger.debug("Got image {} from {}.", _img.id, adapter_name)
+
+        # 同一会话的新图片替换旧图片，旧图片不会再被上传
+        _old_cache = memory.USER_IMAGE_CACHE.get(session_id)
+        _img_path = memory.IMAGE_CACHE.save(_img_bytes, _img)
+        if _old_cache and _old_cache.get("path") != _img_path:
+            memory.IMAGE_CACHE.remove(_old_cache["path"])
+        memory.USER_IMAGE_CACHE[session_id] = {
+                    "id": _img.id,
+                    "path": _img_path
+                }
+        logger.debug("Set image cache: {}, local path: {}.", _img.id, _img_path)
+    else:
+        logger.warning("Failed to fetch image from {}.", adapter_name)
+
+
 @recieve_message.handle()
 async def _(
     bot: Bot,
-    event: Event
+    event: Event,
+    state: T_State
 ):
+    with trace(), deadline(config.dify_message_deadline):
+        await handle_message(bot, event, state)
+
+
+async def handle_message(bot: Bot, event: Event, state: T_State):
+    decision = state["dify_decision"]
+    msg_plaintext = state["dify_query"]
+
+    # 重复投递的事件不再调用dify，丢弃或复用第一次的回复
+    dedup_key = get_dedup_key(bot, event)
+    is_new, reply_future = event_dedup.begin(dedup_key)
+    if not is_new:
+        metrics.inc("events_duplicate")
+        logger.info("Ignored duplicate event {}.", dedup_key)
+        if not config.dify_dedup_resend:
+            await recieve_message.finish()
+        # 等待第一次处理的结果，最多等到当前消息的时间预算用完
+        try:
+            reply = await asyncio.wait_for(asyncio.shield(reply_future), remaining())
+        except asyncio.TimeoutError:
+            logger.info("Timed out waiting for the reply of duplicate event {}.", dedup_key)
+            reply = None
+        if reply is None:
+            await recieve_message.finish()
+        metrics.inc("events_duplicate_resend")
+
     target = UniMessage.get_target()
-    if target.adapter:
-        adapter_name = target.adapter.replace("SupportAdapter.","").lower()
-    else:
-        adapter_name = "default"
-    logger.debug(f"Message target adapter: {adapter_name}.")
-    msg_plaintext = event.message.extract_plain_text()
-    if msg_plaintext == "":
-        logger.debug("Ignored empty plaintext message.")
-        await recieve_message.finish()
+    adapter_name = get_adapter_name(target)
+    logger.debug("Message target adapter: {}, decision: {}.", adapter_name, decision)
 
     user_id = event.get_user_id() if event.get_user_id() else "user"
     full_user_id = f"{adapter_name}-{user_id}"
     session_id = f"s-{full_user_id}"
 
-    _session = dify_bot.sessions.get_session(session_id, full_user_id)
+    if is_new:
+        try:
+            # 插件或dify app未开启图片上传时，不获取图片
+            if app_parameters.can_upload_image():
+                with span("image_fetch"):
+                    await cache_image(bot, event, state, adapter_name, session_id)
 
-    _msg = UniMessage.generate_without_reply(event=event, bot=bot)
-    if _msg.has(Image):
-        imgs = _msg[Image]
-        _img = imgs[0]
-        _img_bytes = await image_fetch(event=event, bot=bot, state=T_State, img=_img)
-        if _img_bytes: 
-            logger.debug(f"Got image {_img.id} from {adapter_name}.")
-
-            cache_dir = store.get_cache_dir("nonebot_plugin_dify")
-            save_dir = os.path.join(cache_dir, config.dify_image_cache_dir)
-
-            _img_path = save_pic(_img_bytes, _img, save_dir)
-            memory.USER_IMAGE_CACHE[session_id] = {
-                        "id": _img.id,
-                        "path": _img_path
-                    }
-            logger.debug(f"Set image cache: {memory.USER_IMAGE_CACHE[session_id]}, local path: {_img_path}.")
-        else:
-            logger.warning(f"Failed to fetch image from {adapter_name}.")
-
-    reply_type, reply_content = await dify_bot.reply(msg_plaintext, full_user_id, session_id)
-
-    _uni_message = UniMessage()
-    for _reply_type, _reply_content in zip(reply_type, reply_content):
-        logger.debug(f"Ready to send {_reply_type}: {type(_reply_content)} {_reply_content}")
-        if _reply_type == ReplyType.IMAGE_URL:
-            _pic_content = await get_pic_from_url(_reply_content)
-            _uni_message += UniMessage(Image(raw=_pic_content))
-        else:
-            _uni_message += UniMessage(f"{_reply_content}")
+            # 只有图片的消息，缓存图片等待后续文本
+            if decision == TriggerDecision.IMAGE_ONLY:
+                reply = None
+            else:
+                with span("dify_reply"):
+                    reply = await dify_bot.reply(msg_plaintext, full_user_id, session_id)
+        except BaseException:
+            # 包括被取消的情况，否则等待该结果的重复事件永远不会结束
+            event_dedup.discard(dedup_key)
+            raise
+        event_dedup.resolve(dedup_key, reply)
+        if reply is None:
+            logger.debug("Ignored empty plaintext message.")
+            await recieve_message.finish()
 
-    if target.private:
-        send_msg = (
-                await _uni_message.export()
-            )
-    else:
-        send_msg = (
-                await UniMessage([At("user", user_id), "\n" + _uni_message]).export()
-        )
+    reply_type, reply_content = reply
+
+    # 群聊中第一条消息at用户
+    header = None if target.private else UniMessage([At("user", user_id), "\n"])
+    delivery = ReplyDelivery(
+        send=lambda message: message.send(target=target, bot=bot),
+        limits=get_adapter_limits(adapter_name, config.dify_reply_limits),
+        download_dir=get_download_dir(),
+        max_download_bytes=config.dify_download_max_size * 1024 * 1024,
+        header=header,
+        retries=config.dify_reply_send_retries,
+        send_path=config.dify_reply_media_path,
+    )
+    with span("deliver"):
+        await delivery.deliver(reply_type, reply_content)
+    await recieve_message.finish()
+
+
+metrics_command: type[Matcher] = on_command("dify_metrics", permission=SUPERUSER, priority=1, block=True)
+
+
+@metrics_command.handle()
+async def _():
+    metrics.set("dedup_cache_size", len(event_dedup))
+    metrics.set("job_queue_depth", job_queue.depth())
+    snapshot = metrics.snapshot()
+    await metrics_command.finish("\n".join(f"{k}: {v}" for k, v in sorted(snapshot.items())))
+
+
+profile_command: type[Matcher] = on_command("dify_profile", permission=SUPERUSER, priority=1, block=True)
+
+
+@profile_command.handle()
+async def _(args: Message = CommandArg()):
+    arg = args.extract_plain_text().strip()
+    seconds = int(arg) if arg.isdigit() else 30
+    seconds = max(1, min(seconds, config.dify_profile_max_seconds))
+    if profiler.running:
+        await profile_command.finish("profiler is already running")
+
+    data_dir = store.get_data_dir("nonebot_plugin_dify")
+    path = os.path.join(data_dir, "profile", f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+    await profile_command.send(f"profiling for {seconds}s ...")
+    try:
+        samples = await profiler.profile(seconds, path)
+    except RuntimeError:
+        # 并发的命令可能同时通过上面的检查
+        await profile_command.finish("profiler is already running")
+    await profile_command.finish(f"profile saved to {path}, {samples} samples")
+
+
+feedback_command: type[Matcher] = on_command("dify_like", aliases={"dify_dislike"}, priority=1, block=True)
+
+
+@feedback_command.handle()
+async def _(event: Event, command: tuple = Command()):
+    rating = "dislike" if command[0] == "dify_dislike" else "like"
+    user_id = event.get_user_id() if event.get_user_id() else "user"
+    full_user_id = f"{get_adapter_name(UniMessage.get_target())}-{user_id}"
+
+    session = dify_bot.sessions.find_session(full_user_id)
+    message_id = session.get_last_message_id() if session else ''
+    if not message_id:
+        await feedback_command.finish("没有可以反馈的回复")
 
-    await recieve_message.finish(send_msg)
+    # 反馈不在回复链路上，交给后台队列
+    if not submit_message_feedback(message_id, rating, full_user_id):
+        await feedback_command.finish("反馈提交失败，请稍后再试")
+    await feedback_command.finish("已收到反馈")
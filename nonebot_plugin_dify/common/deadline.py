@@ -0,0 +1,91 @@
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Deque, Dict, Optional
+
+
+class DeadlineExceeded(Exception):
+    """单条消息的处理时间预算已用完"""
+
+
+class LatencyTracker(object):
+    """
+    按阶段记录最近的成功耗时，用于根据分位数自适应地计算各阶段超时时间
+    """
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=self.window))
+
+    def observe(self, stage: str, seconds: float):
+        self._samples[stage].append(seconds)
+
+    def percentile(self, stage: str, q: float) -> Optional[float]:
+        samples = self._samples.get(stage)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Deadline(object):
+    __slots__ = ("expiry_time",)
+
+    def __init__(self, seconds: float):
+        self.expiry_time = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return self.expiry_time - time.monotonic()
+
+
+_current_deadline: ContextVar[Optional[Deadline]] = ContextVar("dify_deadline", default=None)
+
+stage_latency = LatencyTracker()
+
+# 自适应超时 = p99耗时 * ADAPTIVE_FACTOR，不低于ADAPTIVE_MIN_TIMEOUT
+ADAPTIVE_FACTOR = 3.0
+ADAPTIVE_MIN_TIMEOUT = 5.0
+
+
+@contextmanager
+def deadline(seconds: float):
+    """为当前消息设置端到端的时间预算，<=0时不限制"""
+    if seconds <= 0:
+        yield None
+        return
+    _deadline = Deadline(seconds)
+    token = _current_deadline.set(_deadline)
+    try:
+        yield _deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """当前消息剩余的时间预算，不在预算内时返回None"""
+    _deadline = _current_deadline.get()
+    return _deadline.remaining() if _deadline is not None else None
+
+
+def stage_timeout(stage: str, default: float, grace: float = 0) -> float:
+    """
+    计算一个阶段的超时时间：先根据该阶段的历史耗时分位数收紧默认值，再受剩余预算约束。
+
+    预算已用完时抛出DeadlineExceeded；`grace`大于0时改为返回`grace`，
+    用于超时后仍需完成的阶段，例如发送兜底回复。
+    """
+    timeout = default
+    p99 = stage_latency.percentile(stage, 0.99)
+    if p99 is not None:
+        timeout = min(default, max(ADAPTIVE_MIN_TIMEOUT, p99 * ADAPTIVE_FACTOR))
+
+    left = remaining()
+    if left is not None:
+        if left <= 0:
+            if grace > 0:
+                return grace
+            raise DeadlineExceeded(f"no time budget left for {stage}")
+        timeout = min(timeout, left)
+    return timeout
@@ -0,0 +1,69 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+
+class EventDeduplicator(object):
+    """
+    有界的事件幂等缓存，key为adapter + bot + message id。
+
+    每个key对应一个future，第一次处理的事件负责写入结果，窗口期内重复投递的事件
+    可以直接丢弃，或等待并复用同一个结果，而不会再次调用dify。
+    """
+
+    def __init__(self, window_seconds: int, max_size: int):
+        self.window_seconds = window_seconds
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[float, asyncio.Future]]" = OrderedDict()
+
+    def _evict(self, now: float):
+        # 窗口固定，按插入顺序即按过期时间排序
+        while self._entries:
+            expiry_time, _ = next(iter(self._entries.values()))
+            if expiry_time > now:
+                break
+            self._entries.popitem(last=False)
+        if len(self._entries) < self.max_size:
+            return
+        # 超出容量时从最旧的开始淘汰已完成的条目，跳过进行中的条目，保留到完成
+        excess = len(self._entries) - self.max_size + 1
+        done_keys = []
+        for key, (_, future) in self._entries.items():
+            if len(done_keys) >= excess:
+                break
+            if future.done():
+                done_keys.append(key)
+        for key in done_keys:
+            del self._entries[key]
+
+    def begin(self, key: Optional[str]) -> Tuple[bool, asyncio.Future]:
+        """
+        登记一个事件，返回(是否首次出现, 结果future)
+        """
+        future = asyncio.get_running_loop().create_future()
+        if not key or self.window_seconds <= 0:
+            return True, future
+
+        now = time.monotonic()
+        self._evict(now)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            return False, entry[1]
+
+        self._entries[key] = (now + self.window_seconds, future)
+        return True, future
+
+    def resolve(self, key: Optional[str], result: Any):
+        entry = self._entries.get(key) if key else None
+        if entry is not None and not entry[1].done():
+            entry[1].set_result(result)
+
+    def discard(self, key: Optional[str]):
+        """处理失败时移除key，允许之后的重复投递重新处理"""
+        entry = self._entries.pop(key, None) if key else None
+        if entry is not None and not entry[1].done():
+            entry[1].set_result(None)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,223 @@
+import asyncio
+import os
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from nonebot_plugin_alconna import File, Image, Segment, UniMessage, Video
+
+from .deadline import stage_timeout
+from .metrics import metrics
+from .reply_type import ReplyType
+from .trace import logger, span
+from .utils import download_to_file
+
+
+# 各平台单条消息的限制，key为小写的adapter名称
+# max_chars: 单条消息最大字符数，max_images: 单条消息最多图片数
+ADAPTER_LIMITS: Dict[str, Dict[str, int]] = {
+    "default": {"max_chars": 2000, "max_images": 1},
+    "onebot v11": {"max_chars": 4500, "max_images": 10},
+    "onebot v12": {"max_chars": 4500, "max_images": 10},
+    "telegram": {"max_chars": 4096, "max_images": 1},
+    "discord": {"max_chars": 2000, "max_images": 10},
+    "qq": {"max_chars": 2000, "max_images": 1},
+    "kaiheila": {"max_chars": 8000, "max_images": 1},
+    "feishu": {"max_chars": 10000, "max_images": 1},
+    "dodo": {"max_chars": 2000, "max_images": 1},
+    "satori": {"max_chars": 2000, "max_images": 1},
+}
+
+
+def get_adapter_limits(adapter_name: str, overrides: Optional[Dict[str, Dict[str, int]]] = None) -> Dict[str, int]:
+    limits = dict(ADAPTER_LIMITS["default"])
+    limits.update(ADAPTER_LIMITS.get(adapter_name, {}))
+    if overrides:
+        limits.update(overrides.get("default", {}))
+        limits.update(overrides.get(adapter_name, {}))
+    return limits
+
+
+def split_text(text: str, max_chars: int, reserved: int = 0) -> List[str]:
+    """
+    按字符数上限切分文本，优先在换行处切分
+    reserved为第一段需要预留的字符数，例如第一条消息前的header
+    """
+    if max_chars <= 0:
+        return [text] if text else []
+    limit = max(1, max_chars - reserved)
+    if len(text) <= limit:
+        return [text] if text else []
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        # 换行位置太靠前时直接按上限切分，避免产生过多短消息
+        if cut < limit // 2:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+        limit = max_chars
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+def build_chunks(
+    reply_type: list, reply_content: list, limits: Dict[str, int], header_chars: int = 0
+) -> List[Tuple[str, List]]:
+    """
+    将回复切分为按顺序发送的消息块，header_chars为第一条消息前header占用的字符数
+    返回[("text", [文本]), ("image", [图片url, ...]), ("video", [url]), ("file", [url]), ...]
+    """
+    chunks: List[Tuple[str, List]] = []
+    for _reply_type, _reply_content in zip(reply_type, reply_content):
+        if _reply_type == ReplyType.IMAGE_URL:
+            # 连续的图片合并发送，不超过单条消息图片数上限
+            if chunks and chunks[-1][0] == "image" and len(chunks[-1][1]) < limits["max_images"]:
+                chunks[-1][1].append(_reply_content)
+            else:
+                chunks.append(("image", [_reply_content]))
+        elif _reply_type == ReplyType.VIDEO_URL:
+            chunks.append(("video", [_reply_content]))
+        elif _reply_type == ReplyType.FILE:
+            chunks.append(("file", [_reply_content]))
+        else:
+            reserved = header_chars if not chunks else 0
+            for text in split_text(f"{_reply_content}", limits["max_chars"], reserved):
+                chunks.append(("text", [text]))
+    return chunks
+
+
+# 各类媒体允许/拒绝的content-type前缀
+MEDIA_CONTENT_TYPES: Dict[str, Tuple[Tuple[str, ...], Tuple[str, ...]]] = {
+    "image": (("image/",), ()),
+    "video": (("video/",), ()),
+    # 普通网页链接不作为文件发送
+    "file": ((), ("text/html",)),
+}
+
+
+class ReplyDelivery(object):
+    """
+    回复发送阶段：按adapter限制切分回复，图片、视频、文件在后台并行流式下载到临时文件，
+    文本立即发送，整体保持原有顺序，单个消息块发送失败只重试该块，媒体无法下载或发送时改为发送链接。
+
+    媒体默认在发送前读取为bytes；`send_path`为True时只传递文件路径，仅适用于协议端与bot共享文件系统的情况。
+    """
+
+    def __init__(
+        self,
+        send: Callable[[UniMessage], Awaitable],
+        limits: Dict[str, int],
+        download_dir: str,
+        max_download_bytes: int = 0,
+        header: Optional[UniMessage] = None,
+        retries: int = 2,
+        retry_interval: float = 1,
+        send_path: bool = False,
+    ):
+        self.send = send
+        self.limits = limits
+        self.download_dir = download_dir
+        self.max_download_bytes = max_download_bytes
+        self.header = header
+        self.retries = retries
+        self.retry_interval = retry_interval
+        self.send_path = send_path
+
+    async def _send_chunk(self, message: UniMessage) -> bool:
+        # 第一条消息带上header，例如群聊中at用户
+        if self.header is not None:
+            message = self.header + message
+        for i in range(self.retries + 1):
+            try:
+                # 预算用完后仍保留一小段时间用于发送，保证兜底回复能送达
+                with span("send", observe=True):
+                    await asyncio.wait_for(self.send(message), stage_timeout("send", 30, grace=10))
+                self.header = None
+                return True
+            except Exception as e:
+                logger.warning(f"[DIFY] failed to send reply segment, retry {i}/{self.retries}: {e}")
+                if i < self.retries:
+                    await asyncio.sleep(self.retry_interval)
+        metrics.inc("reply_segments_failed")
+        return False
+
+    def _download(self, kind: str, url: str) -> asyncio.Task:
+        allowed_types, rejected_types = MEDIA_CONTENT_TYPES[kind]
+        return asyncio.create_task(
+            download_to_file(url, self.download_dir, self.max_download_bytes, allowed_types, rejected_types)
+        )
+
+    async def _build_media(self, kind: str, url: str, path: str, content_type: Optional[str]) -> Segment:
+        if self.send_path:
+            # 只传递文件路径，由adapter在发送时读取，例如onebot v11会转为file://链接
+            media = {"path": Path(path)}
+        else:
+            # 协议端可能运行在其他容器或主机上，发送前才读取文件内容
+            media = {"raw": await asyncio.to_thread(Path(path).read_bytes)}
+        if kind == "image":
+            return Image(mimetype=content_type, **media)
+        if kind == "video":
+            return Video(mimetype=content_type, **media)
+        name = os.path.basename(urlparse(url).path) or os.path.basename(path)
+        return File(mimetype=content_type, name=name, **media)
+
+    async def deliver(self, reply_type: list, reply_content: list) -> bool:
+        header_chars = len(str(self.header)) if self.header is not None else 0
+        chunks = build_chunks(reply_type, reply_content, self.limits, header_chars)
+        # 所有媒体立即开始下载
+        downloads: Dict[Tuple[str, str], asyncio.Task] = {}
+        for kind, items in chunks:
+            if kind != "text":
+                for url in items:
+                    if (kind, url) not in downloads:
+                        downloads[(kind, url)] = self._download(kind, url)
+
+        success = True
+        try:
+            for kind, items in chunks:
+                logger.debug("Ready to send {}: {}", kind, items)
+                if kind == "text":
+                    success = await self._send_chunk(UniMessage(items[0])) and success
+                    continue
+
+                message = UniMessage()
+                sent_urls = []
+                fallback = []
+                results = await asyncio.gather(*(downloads[(kind, url)] for url in items), return_exceptions=True)
+                for url, result in zip(items, results):
+                    if isinstance(result, BaseException):
+                        logger.warning(f"[DIFY] failed to download reply {kind} {url}: {result!r}")
+                        metrics.inc(f"reply_{kind}s_failed")
+                        fallback.append(url)
+                    else:
+                        try:
+                            message += await self._build_media(kind, url, *result)
+                        except OSError as e:
+                            logger.warning(f"[DIFY] failed to read reply {kind} {url}: {e!r}")
+                            fallback.append(url)
+                            continue
+                        sent_urls.append(url)
+                if message and not await self._send_chunk(message):
+                    success = False
+                    # 只补充本条消息中的链接，下载失败的已在fallback中
+                    fallback.extend(sent_urls)
+                # 图片、视频和文件无法下载或发送时退回为发送链接
+                if fallback:
+                    success = await self._send_chunk(UniMessage("\n".join(fallback))) and success
+        finally:
+            for task in downloads.values():
+                task.cancel()
+            await asyncio.gather(*downloads.values(), return_exceptions=True)
+            paths = [task.result()[0] for task in downloads.values() if not task.cancelled() and not task.exception()]
+            await asyncio.to_thread(_remove_files, paths)
+        return success
+
+
+def _remove_files(paths: List[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
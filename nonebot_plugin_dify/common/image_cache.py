@@ -0,0 +1,130 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from nonebot import logger
+from nonebot_plugin_alconna import Image
+
+from .utils import save_pic
+
+
+class ImageCache(object):
+    """
+    有大小和时间上限的图片缓存目录。
+
+    内存中按LRU顺序维护文件索引(路径 -> (大小, 最后访问时间))，启动时扫描目录重建索引，
+    后台定时清理过期文件，超出大小上限时从最久未访问的文件开始淘汰。
+    """
+
+    def __init__(self, max_bytes: int, max_age: int):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.directory: Optional[str] = None
+        self.total_bytes = 0
+        self._index: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+        self._sweep_task: Optional[asyncio.Task] = None
+
+    def _add(self, path: str, size: int, access_time: float):
+        self._pop(path)
+        self._index[path] = (size, access_time)
+        self.total_bytes += size
+
+    def _pop(self, path: str) -> bool:
+        entry = self._index.pop(path, None)
+        if entry is None:
+            return False
+        self.total_bytes -= entry[0]
+        return True
+
+    def scan(self):
+        """扫描缓存目录重建索引，用于启动时接管上次运行遗留的文件"""
+        self._index.clear()
+        self.total_bytes = 0
+        if not self.directory or not os.path.isdir(self.directory):
+            return
+        files = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.path, stat.st_size))
+        for mtime, path, size in sorted(files):
+            self._add(path, size, mtime)
+        logger.debug(f"[DIFY] image cache scanned {len(self._index)} files, {self.total_bytes} bytes.")
+
+    def save(self, img_bytes: bytes, img: Image) -> str:
+        path = save_pic(img_bytes, img, self.directory)
+        self._add(path, len(img_bytes), time.time())
+        self._evict_oversize()
+        return path
+
+    def touch(self, path: str):
+        entry = self._index.get(path)
+        if entry is not None:
+            self._index[path] = (entry[0], time.time())
+            self._index.move_to_end(path)
+
+    def remove(self, path: str):
+        self._pop(path)
+        self._unlink(path)
+
+    def _collect(self, now: float) -> List[str]:
+        """从索引中移除过期和超出大小上限的文件，返回需要删除的路径"""
+        victims = []
+        while self._index:
+            path, (size, access_time) = next(iter(self._index.items()))
+            expired = self.max_age > 0 and access_time + self.max_age < now
+            oversize = self.max_bytes > 0 and self.total_bytes > self.max_bytes
+            if not expired and not oversize:
+                break
+            self._pop(path)
+            victims.append(path)
+        return victims
+
+    def _evict_oversize(self):
+        # 写入新文件后只按大小淘汰，过期文件交给后台清理
+        victims = []
+        while self.max_bytes > 0 and self.total_bytes > self.max_bytes and len(self._index) > 1:
+            path, _ = next(iter(self._index.items()))
+            self._pop(path)
+            victims.append(path)
+        for path in victims:
+            self._unlink(path)
+
+    @staticmethod
+    def _unlink(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"[DIFY] failed to remove cached image {path}: {e}")
+
+    async def sweep(self):
+        victims = self._collect(time.time())
+        if victims:
+            await asyncio.to_thread(lambda: [self._unlink(x) for x in victims])
+            logger.debug(f"[DIFY] image cache evicted {len(victims)} files, {self.total_bytes} bytes left.")
+
+    async def _sweep_loop(self, interval: int):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.warning(f"[DIFY] image cache sweep failed: {e}")
+
+    async def start(self, directory: str, interval: int):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        await asyncio.to_thread(self.scan)
+        await self.sweep()
+        if interval > 0 and self._sweep_task is None:
+            self._sweep_task = asyncio.create_task(self._sweep_loop(interval))
+
+    async def stop(self):
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+            self._sweep_task = None
@@ -0,0 +1,240 @@
+import asyncio
+import json
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from nonebot import logger
+
+from .metrics import metrics
+
+
+class PermanentJobError(Exception):
+    """任务无法通过重试完成(例如请求参数错误、资源已删除)，直接丢弃"""
+
+
+class Job(object):
+    __slots__ = ("kind", "payload", "key", "attempts")
+
+    def __init__(self, kind: str, payload: dict, key: Optional[str] = None, attempts: int = 0):
+        self.kind = kind
+        self.payload = payload
+        # key相同的任务在同一批次中只执行最后一个
+        self.key = key
+        self.attempts = attempts
+
+    def to_dict(self) -> dict:
+        return {"kind": self.kind, "payload": self.payload, "key": self.key, "attempts": self.attempts}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Job":
+        return cls(data["kind"], data["payload"], data.get("key"), data.get("attempts", 0))
+
+
+class JobQueue(object):
+    """
+    非关键dify API调用(反馈、会话命名等)的后台任务队列。
+
+    有界队列 + 少量worker，每次取出一批任务并合并重复任务，所有worker共享调用频率限制，
+    失败按指数退避重试。未完成的任务定期写入文件，关闭时再写入一次，下次启动时恢复。
+    """
+
+    def __init__(
+        self,
+        handlers: Dict[str, Callable[[dict], Awaitable]],
+        maxsize: int = 1000,
+        workers: int = 2,
+        rate_limit: float = 5,
+        max_retries: int = 5,
+        batch_size: int = 20,
+        snapshot_interval: float = 5,
+    ):
+        self.handlers = handlers
+        self.maxsize = maxsize
+        self.workers = workers
+        self.rate_limit = rate_limit
+        self.max_retries = max_retries
+        self.batch_size = batch_size
+        self.snapshot_interval = snapshot_interval
+        self.persist_path: Optional[str] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self._delayed: Dict[asyncio.Task, Job] = {}
+        # 所有未完成的任务(排队中、执行中、等待重试)，按提交顺序保存，用于持久化
+        self._pending: Dict[Job, None] = {}
+        self._dirty = False
+        self._snapshot_task: Optional[asyncio.Task] = None
+        self._rate_lock = asyncio.Lock()
+        self._next_call_time = 0.0
+
+    def depth(self) -> int:
+        queued = self._queue.qsize() if self._queue is not None else 0
+        return queued + sum(1 for task in self._delayed if not task.done())
+
+    def _update_depth(self):
+        metrics.set("job_queue_depth", self.depth())
+
+    def _add_pending(self, job: Job):
+        self._pending[job] = None
+        self._dirty = True
+
+    def _finish(self, job: Job):
+        self._pending.pop(job, None)
+        self._dirty = True
+
+    def submit(self, kind: str, payload: dict, key: Optional[str] = None) -> bool:
+        """提交任务，不等待执行；队列已满、未启动或已关闭时丢弃并返回False"""
+        if self._queue is None or kind not in self.handlers:
+            return False
+        job = Job(kind, payload, key)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            logger.warning(f"[DIFY] job queue is full, dropped {kind} job.")
+            metrics.inc("jobs_dropped")
+            return False
+        self._add_pending(job)
+        self._update_depth()
+        return True
+
+    async def _wait_rate_limit(self):
+        if self.rate_limit <= 0:
+            return
+        async with self._rate_lock:
+            now = time.monotonic()
+            if self._next_call_time > now:
+                await asyncio.sleep(self._next_call_time - now)
+            self._next_call_time = max(now, self._next_call_time) + 1 / self.rate_limit
+
+    def _retry_later(self, job: Job):
+        job.attempts += 1
+        self._dirty = True
+        if job.attempts > self.max_retries:
+            logger.warning(f"[DIFY] {job.kind} job failed after {self.max_retries} retries, dropped.")
+            metrics.inc("jobs_failed")
+            self._finish(job)
+            return
+        delay = min(2 ** job.attempts, 300)
+        task = asyncio.create_task(self._requeue(job, delay))
+        self._delayed[task] = job
+        task.add_done_callback(lambda t: self._delayed.pop(t, None))
+
+    async def _requeue(self, job: Job, delay: float):
+        await asyncio.sleep(delay)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            metrics.inc("jobs_dropped")
+            self._finish(job)
+
+    def _next_batch(self, first: Job) -> List[Job]:
+        batch = [first]
+        while len(batch) < self.batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        # 合并key相同的任务，保留最后提交的
+        merged: Dict[object, Job] = {}
+        for index, job in enumerate(batch):
+            merge_key = (job.kind, job.key) if job.key else index
+            if merge_key in merged:
+                self._finish(merged[merge_key])
+            merged[merge_key] = job
+        metrics.inc("jobs_merged", len(batch) - len(merged))
+        return list(merged.values())
+
+    async def _worker(self):
+        while True:
+            first = await self._queue.get()
+            batch = self._next_batch(first)
+            self._update_depth()
+            for job in batch:
+                # 被取消时本批次未完成的任务仍在_pending中，关闭时一起保存
+                try:
+                    await self._wait_rate_limit()
+                    await self.handlers[job.kind](job.payload)
+                    metrics.inc("jobs_done")
+                    self._finish(job)
+                except PermanentJobError as e:
+                    logger.warning(f"[DIFY] {job.kind} job failed permanently, dropped: {e} payload={job.payload}")
+                    metrics.inc("jobs_failed")
+                    self._finish(job)
+                except Exception as e:
+                    logger.warning(f"[DIFY] {job.kind} job failed, attempt {job.attempts + 1}: {e}")
+                    self._retry_later(job)
+            self._update_depth()
+
+    def _load(self) -> List[Job]:
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return []
+        try:
+            with open(self.persist_path, "r", encoding="utf-8") as f:
+                jobs = [Job.from_dict(x) for x in json.load(f)]
+        except Exception as e:
+            logger.warning(f"[DIFY] failed to load pending jobs from {self.persist_path}: {e}")
+            return []
+        return jobs
+
+    def _save(self, jobs: List[dict]):
+        if not self.persist_path:
+            return
+        if not jobs:
+            if os.path.exists(self.persist_path):
+                os.remove(self.persist_path)
+            return
+        os.makedirs(os.path.dirname(self.persist_path), exist_ok=True)
+        # 先写临时文件再替换，避免写入中途退出导致文件损坏
+        tmp_path = f"{self.persist_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(jobs, f, ensure_ascii=False)
+        os.replace(tmp_path, self.persist_path)
+
+    def _snapshot(self) -> List[dict]:
+        self._dirty = False
+        return [x.to_dict() for x in self._pending]
+
+    async def _snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            if not self._dirty:
+                continue
+            try:
+                await asyncio.to_thread(self._save, self._snapshot())
+            except Exception as e:
+                self._dirty = True
+                logger.warning(f"[DIFY] failed to save pending jobs to {self.persist_path}: {e}")
+
+    async def start(self, persist_path: Optional[str] = None):
+        self.persist_path = persist_path
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        jobs = self._load()
+        for job in jobs[: self.maxsize]:
+            if job.kind in self.handlers:
+                self._queue.put_nowait(job)
+                self._add_pending(job)
+        if jobs:
+            logger.info(f"[DIFY] restored {self._queue.qsize()} pending jobs.")
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if self.persist_path and self.snapshot_interval > 0:
+            self._snapshot_task = asyncio.create_task(self._snapshot_loop())
+        self._update_depth()
+
+    async def stop(self):
+        # 之后提交的任务直接拒绝
+        self._queue = None
+        tasks = self._worker_tasks + list(self._delayed)
+        if self._snapshot_task is not None:
+            tasks.append(self._snapshot_task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._worker_tasks = []
+        self._snapshot_task = None
+        # 排队中、执行中和等待重试的任务都在_pending中，每个任务只保存一次
+        pending = self._snapshot()
+        self._pending.clear()
+        try:
+            self._save(pending)
+        except Exception as e:
+            logger.warning(f"[DIFY] failed to save pending jobs to {self.persist_path}: {e}")
+            return
+        if pending:
+            logger.info(f"[DIFY] saved {len(pending)} pending jobs.")
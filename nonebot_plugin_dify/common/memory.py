@@ -1,3 +1,10 @@
+from ..config import config
 from .expired_dict import ExpiredDict
+from .image_cache import ImageCache
 
-USER_IMAGE_CACHE = ExpiredDict(60 * 3)
\ No newline at end of file
+USER_IMAGE_CACHE = ExpiredDict(60 * 3)
+
+IMAGE_CACHE = ImageCache(
+    config.dify_image_cache_max_size * 1024 * 1024,
+    config.dify_image_cache_max_age,
+)
\ No newline at end of file
@@ -0,0 +1,24 @@
+from collections import defaultdict
+from typing import Dict, Union
+
+
+class Metrics(object):
+    """进程内的简单计数器和瞬时值，供`dify_metrics`指令查看"""
+
+    def __init__(self):
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.gauges: Dict[str, Union[int, float]] = {}
+
+    def inc(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    def set(self, name: str, value: Union[int, float]):
+        self.gauges[name] = value
+
+    def snapshot(self) -> Dict[str, Union[int, float]]:
+        data = dict(self.counters)
+        data.update(self.gauges)
+        return data
+
+
+metrics = Metrics()
@@ -0,0 +1,66 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+
+class SamplingProfiler(object):
+    """
+    采样分析器，在后台线程中定时采样事件循环所在线程的调用栈，
+    结果以folded stacks格式写入文件，可直接用flamegraph.pl或speedscope查看。
+    同一时间只允许一次采样。
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    @staticmethod
+    def _format_stack(frame) -> str:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        return ";".join(reversed(stack))
+
+    def _sample(self, thread_id: int, seconds: float) -> Counter:
+        stacks: Counter = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                stacks[self._format_stack(frame)] += 1
+            del frame
+            time.sleep(self.interval)
+        return stacks
+
+    def _write(self, stacks: Counter, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+    async def profile(self, seconds: float, path: str, thread_id: Optional[int] = None) -> int:
+        """
+        采样`seconds`秒并写入`path`，返回采样次数
+        """
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("profiler is already running")
+        try:
+            thread_id = thread_id or threading.get_ident()
+            stacks = await asyncio.to_thread(self._sample, thread_id, seconds)
+            await asyncio.to_thread(self._write, stacks, path)
+            return sum(stacks.values())
+        finally:
+            self._lock.release()
+
+
+profiler = SamplingProfiler()
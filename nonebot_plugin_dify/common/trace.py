@@ -0,0 +1,101 @@
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional, Tuple
+
+from nonebot import get_driver, logger as _logger
+
+from .deadline import stage_latency
+
+
+class Trace(object):
+    """单条消息的处理链路，记录各阶段(span)的耗时"""
+
+    __slots__ = ("trace_id", "start_time", "spans")
+
+    def __init__(self, trace_id: Optional[str] = None):
+        self.trace_id = trace_id or uuid.uuid4().hex[:8]
+        self.start_time = time.perf_counter()
+        self.spans: List[Tuple[str, float]] = []
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.start_time) * 1000
+
+    def summary(self) -> str:
+        spans = ", ".join(f"{name}={duration:.1f}ms" for name, duration in self.spans)
+        return f"total={self.elapsed_ms():.1f}ms {spans}"
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("dify_trace", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def _inject_trace(record):
+    # 同一条消息的所有日志带上相同的trace_id，asyncio任务会继承当前context
+    trace = _current_trace.get()
+    if trace is not None:
+        record["extra"]["trace_id"] = trace.trace_id
+        record["message"] = f"[{trace.trace_id}] {record['message']}"
+
+
+logger = _logger.patch(_inject_trace)
+
+_debug_enabled: Optional[bool] = None
+
+
+def debug_enabled() -> bool:
+    """
+    当前LOG_LEVEL是否输出debug日志。
+
+    NoneBot的默认sink以level=0注册，在sink内才按LOG_LEVEL过滤，loguru仍会格式化每条debug日志，
+    `opt(lazy=True)`的参数也会被执行，参数较大的debug日志需要先用此函数判断。
+    """
+    global _debug_enabled
+    if _debug_enabled is None:
+        try:
+            log_level = get_driver().config.log_level
+            if isinstance(log_level, str):
+                log_level = _logger.level(log_level.upper()).no
+        except ValueError:
+            # nonebot未初始化或无法识别的日志等级，此时不缓存结果
+            return True
+        _debug_enabled = log_level <= _logger.level("DEBUG").no
+    return _debug_enabled
+
+
+@contextmanager
+def trace(trace_id: Optional[str] = None):
+    """开始一条消息的trace，结束时输出各阶段耗时"""
+    _trace = Trace(trace_id)
+    token = _current_trace.set(_trace)
+    try:
+        yield _trace
+    finally:
+        if debug_enabled():
+            logger.debug("[TRACE] {}", _trace.summary())
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name: str, observe: bool = False):
+    """
+    记录一个阶段的耗时；observe为True时成功完成的耗时同时用于计算该阶段的自适应超时，
+    只应用于直接包裹网络调用、且与stage_timeout同名的阶段
+    """
+    _trace = _current_trace.get()
+    start_time = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        duration = time.perf_counter() - start_time
+        if ok and observe:
+            stage_latency.observe(name, duration)
+        if _trace is not None:
+            _trace.spans.append((name, duration * 1000))
+            logger.debug("[TRACE] span {} took {:.1f}ms", name, duration * 1000)
@@ -0,0 +1,101 @@
+import re
+from enum import Enum
+from typing import Iterable, Optional, Pattern, Tuple
+
+
+class TriggerDecision(Enum):
+    SKIP = 0  # 不处理
+    HANDLE = 1  # 交给dify处理
+    IMAGE_ONLY = 2  # 没有文本，只可能缓存消息中的图片
+
+    def __str__(self):
+        return self.name
+
+
+def _compile_words(words: Iterable[str]) -> Optional[Pattern]:
+    """将一组词编译为一个正则，长词优先匹配，这样触发词能被完整去除"""
+    words = sorted({x for x in words if x}, key=len, reverse=True)
+    if not words:
+        return None
+    return re.compile("|".join(re.escape(x) for x in words))
+
+
+class TriggerEngine(object):
+    """
+    消息预过滤，只使用原始纯文本、是否@机器人以及群号做判断，
+    在任何获取target、生成UniMessage、下载图片之前一次性给出结果。
+    """
+
+    def __init__(
+        self,
+        ignore_prefix: Iterable[str] = (),
+        trigger_prefix: Iterable[str] = (),
+        block_keywords: Iterable[str] = (),
+        group_whitelist: Iterable[str] = (),
+        group_blacklist: Iterable[str] = (),
+    ):
+        self._ignore_prefix = _compile_words(ignore_prefix)
+        self._trigger_prefix = _compile_words(trigger_prefix)
+        self._block_keywords = _compile_words(block_keywords)
+        self._group_whitelist = frozenset(str(x) for x in group_whitelist)
+        self._group_blacklist = frozenset(str(x) for x in group_blacklist)
+
+    @property
+    def has_group_filter(self) -> bool:
+        return bool(self._group_whitelist or self._group_blacklist)
+
+    def decide(self, text: str, is_tome: bool, group_id: Optional[str] = None) -> Tuple[TriggerDecision, str]:
+        """
+        返回判断结果和去除触发词后的文本
+        group_id为None表示私聊，为空字符串表示群聊但无法获取群号
+        """
+        if group_id is not None:
+            # 配置了白名单/黑名单但无法确定群号时不触发，避免名单失效
+            if not group_id and self.has_group_filter:
+                return TriggerDecision.SKIP, text
+            if group_id in self._group_blacklist:
+                return TriggerDecision.SKIP, text
+            if self._group_whitelist and group_id not in self._group_whitelist:
+                return TriggerDecision.SKIP, text
+
+        # 消息以忽略词开头
+        if self._ignore_prefix is not None and self._ignore_prefix.match(text):
+            return TriggerDecision.SKIP, text
+
+        # 消息以触发词开头，无需at也触发
+        triggered = False
+        if self._trigger_prefix is not None:
+            matched = self._trigger_prefix.match(text)
+            if matched:
+                text = text[matched.end():].lstrip()
+                triggered = True
+
+        # at 始终触发
+        if not triggered and not is_tome:
+            return TriggerDecision.SKIP, text
+
+        if self._block_keywords is not None and self._block_keywords.search(text):
+            return TriggerDecision.SKIP, text
+
+        if not text:
+            return TriggerDecision.IMAGE_ONLY, text
+
+        return TriggerDecision.HANDLE, text
+
+
+def get_group_id(event) -> Optional[str]:
+    """
+    不依赖具体adapter，尽量廉价地获取群/频道id，获取不到时返回None(包括私聊)
+
+    支持onebot v11/v12、qq(group_openid、频道)、kook、discord、telegram等直接带群号字段的事件，
+    其他adapter(satori、飞书等)由调用方通过alconna的target获取
+    """
+    for attr in ("group_id", "group_openid", "guild_id", "channel_id"):
+        value = getattr(event, attr, None)
+        if value:
+            return str(value)
+    # telegram
+    chat = getattr(event, "chat", None)
+    if chat is not None and getattr(chat, "type", "private") != "private":
+        return str(getattr(chat, "id", ""))
+    return None
@@ -1,14 +1,21 @@
 import httpx
-from nonebot import logger
+from .trace import logger, span
+from .deadline import remaining, stage_timeout
 import asyncio
+import mimetypes
 import re
 import os
+import tempfile
+from urllib.parse import urlparse
 from nonebot_plugin_alconna import Image
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 
 
-async def get_pic_from_url(url: str) -> bytes:
-    logger.debug(f"Got image url {url} for download.")
+class DownloadError(Exception):
+    """内容类型或大小不符合要求，不再重试"""
+
+
+def _get_verify(url: str):
     # 兼容域名`multimedia.nt.qq.com.cn`的TLS套件
     # https://github.com/LagrangeDev/Lagrange.Core/issues/315
     if 'multimedia.nt.qq.com.cn' in url:
@@ -21,16 +28,84 @@ async def get_pic_from_url(url: str) -> bytes:
         SSL_CONTEXT.options |= ssl.OP_NO_TLSv1_1
         SSL_CONTEXT.options |= ssl.OP_NO_COMPRESSION
         logger.debug("Set TLSv1.2 cipher for multimedia.nt.qq.com.cn.")
+        return SSL_CONTEXT
+    return True
+
+
+async def _stream_to_file(
+    client: httpx.AsyncClient,
+    url: str,
+    directory: str,
+    max_bytes: int,
+    allowed_types: Tuple[str, ...],
+    rejected_types: Tuple[str, ...],
+    timeout: float,
+) -> Tuple[str, Optional[str]]:
+    async with client.stream("GET", url, timeout=timeout, follow_redirects=True) as resp:
+        if 400 <= resp.status_code < 500:
+            raise DownloadError(f"{url} returned status_code={resp.status_code}")
+        resp.raise_for_status()
+        content_type = resp.headers.get("content-type", "").split(";")[0].strip().lower() or None
+        if allowed_types and not (content_type and content_type.startswith(allowed_types)):
+            raise DownloadError(f"unexpected content-type {content_type} of {url}")
+        if rejected_types and content_type and content_type.startswith(rejected_types):
+            raise DownloadError(f"unexpected content-type {content_type} of {url}")
+        content_length = int(resp.headers.get("content-length") or 0)
+        if max_bytes and content_length > max_bytes:
+            raise DownloadError(f"{url} is too large: {content_length} bytes")
+
+        suffix = os.path.splitext(urlparse(url).path)[1]
+        if not suffix and content_type:
+            suffix = mimetypes.guess_extension(content_type) or ""
+        fd, path = tempfile.mkstemp(dir=directory, suffix=suffix)
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                # 分块写入临时文件，不在内存中保留完整内容
+                async for chunk in resp.aiter_bytes(64 * 1024):
+                    size += len(chunk)
+                    if max_bytes and size > max_bytes:
+                        raise DownloadError(f"{url} is too large: more than {max_bytes} bytes")
+                    f.write(chunk)
+        except BaseException:
+            os.remove(path)
+            raise
+    logger.debug("Downloaded {} to {}, {} bytes, content-type {}.", url, path, size, content_type)
+    return path, content_type
+
+
+async def download_to_file(
+    url: str,
+    directory: str,
+    max_bytes: int = 0,
+    allowed_types: Tuple[str, ...] = (),
+    rejected_types: Tuple[str, ...] = (),
+) -> Tuple[str, Optional[str]]:
+    """
+    流式下载url到directory下的临时文件，返回(文件路径, content-type)，文件由调用方负责删除
 
-    async with httpx.AsyncClient() as client:
+    allowed_types/rejected_types为content-type前缀，例如("image/",)
+    """
+    logger.debug("Got url {} for download.", url)
+    os.makedirs(directory, exist_ok=True)
+    async with httpx.AsyncClient(verify=_get_verify(url)) as client:
         for i in range(3):
+            # 预算用完时stage_timeout抛出DeadlineExceeded，不再重试
+            timeout = stage_timeout("download", 20)
+            left = remaining()
             try:
-                resp = await client.get(url, timeout=20)
-                resp.raise_for_status()
-                return resp.content
+                with span("download", observe=True):
+                    # timeout只限制单次读写，整个下载受剩余预算限制
+                    return await asyncio.wait_for(
+                        _stream_to_file(client, url, directory, max_bytes, allowed_types, rejected_types, timeout),
+                        left,
+                    )
+            except DownloadError:
+                raise
             except Exception as e:
-                logger.error(f"Error downloading {url}, retry {i}/3: {e}")
-                await asyncio.sleep(3)
+                logger.error(f"Error downloading {url}, retry {i}/3: {e!r}")
+                left = remaining()
+                await asyncio.sleep(3 if left is None else max(0, min(3, left)))
     raise Exception(f"{url} 下载失败！")
 
 
@@ -1,4 +1,4 @@
-from typing import List, Literal, Optional, Union, Set
+from typing import Dict, List, Literal, Optional, Union, Set
 
 from nonebot import get_plugin_config
 from pydantic import BaseModel
@@ -20,6 +20,63 @@ class Config(BaseModel):
     dify_ignore_prefix: Set[str] = ["/", "."]
     """忽略词，指令以本 Set 中的元素开头不会触发词库回复"""
 
+    dify_trigger_prefix: Set[str] = []
+    """触发词，消息以本 Set 中的元素开头时无需at也会触发，触发词不会发送给dify"""
+
+    dify_block_keywords: Set[str] = []
+    """屏蔽词，消息包含本 Set 中的元素时不触发"""
+
+    dify_group_whitelist: Set[str] = []
+    """群/频道白名单，不为空时只在这些群中触发"""
+
+    dify_group_blacklist: Set[str] = []
+    """群/频道黑名单，这些群中不触发"""
+
+    dify_dedup_window: int = 300
+    """重复投递事件的去重窗口，单位秒，0为关闭去重"""
+
+    dify_dedup_max_size: int = 4096
+    """去重缓存最多保存的事件数"""
+
+    dify_dedup_resend: bool = False
+    """收到重复投递的事件时是否重新发送第一次的回复，默认直接丢弃"""
+
+    dify_reply_limits: Dict[str, Dict[str, int]] = {}
+    """覆盖各平台单条消息的限制，如 {"telegram": {"max_chars": 4096, "max_images": 1}}，key为小写的adapter名称"""
+
+    dify_download_max_size: int = 50
+    """回复中单个图片、视频、文件的下载大小上限，单位MB，超出时改为发送链接，0为不限制"""
+
+    dify_reply_media_path: bool = False
+    """回复中的图片、视频、文件是否以本地文件路径交给adapter发送，只适用于协议端与bot共享文件系统的情况，默认读取为bytes发送"""
+
+    dify_reply_send_retries: int = 2
+    """回复中单条消息发送失败时的重试次数"""
+
+    dify_profile_max_seconds: int = 300
+    """`/dify_profile`指令单次采样的最长时间，单位秒"""
+
+    dify_message_deadline: int = 90
+    """单条消息从收到到回复发送完成的总时间预算，单位秒，获取图片、上传、请求dify、下载回复图片、发送都从中扣除，0为不限制"""
+
+    dify_timeout_reply: str = "请求超时，请稍后再试"
+    """时间预算用完时的兜底回复"""
+
+    dify_auto_rename_conversation: bool = False
+    """新建dify会话后是否在后台由dify自动生成会话名"""
+
+    dify_job_queue_size: int = 1000
+    """后台任务队列(消息反馈、会话命名等)的最大长度，超出时丢弃新任务"""
+
+    dify_job_workers: int = 2
+    """后台任务的worker数"""
+
+    dify_job_rate_limit: float = 5
+    """后台任务每秒最多调用dify API的次数，0为不限制"""
+
+    dify_job_max_retries: int = 5
+    """后台任务失败后的最大重试次数，按指数退避重试"""
+
     dify_expires_in_seconds: int = 3600
     """会话过期的时间，单位秒"""
 
@@ -27,7 +84,19 @@ class Config(BaseModel):
     """是否开启图片上传功能，注意需要`nonebot_plugin_alconna`对具体adapter支持图片上传"""
 
     dify_image_cache_dir: str = "image"
-    """忽略词，指令以本 Set 中的元素开头不会触发词库回复"""
+    """图片缓存目录，位于`nonebot_plugin_localstore`的缓存目录下"""
+
+    dify_image_cache_max_size: int = 256
+    """图片缓存目录的大小上限，单位MB，超出时淘汰最久未使用的图片，0为不限制"""
+
+    dify_image_cache_max_age: int = 600
+    """图片缓存的过期时间，单位秒，0为不过期"""
+
+    dify_image_cache_sweep_interval: int = 300
+    """后台清理图片缓存的间隔，单位秒，0为只在启动时清理"""
+
+    dify_parameters_refresh_interval: int = 600
+    """dify app参数(图片上传开关、文件大小限制等)的后台刷新间隔，单位秒，0为只在启动时获取"""
 
 
 config = get_plugin_config(Config)
\ No newline at end of file
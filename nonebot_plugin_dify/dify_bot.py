@@ -1,13 +1,17 @@
+import asyncio
 import json
 import mimetypes
 import os
 
 import httpx
-from nonebot import logger
+from .common.trace import debug_enabled, logger, span
+from .common.deadline import DeadlineExceeded, remaining, stage_timeout
 
 from .dify_session import DifySession, DifySessionManager
 from .config import config
 from .dify_client import DifyClient, ChatClient
+from .dify_jobs import submit_rename_conversation
+from .dify_parameters import app_parameters
 from .common.utils import parse_markdown_text
 from .common.reply_type import ReplyType
 from .common import memory
@@ -20,10 +24,10 @@ class DifyBot():
 
     async def reply(self, query, user_id, session_id):
         # acquire reply content
-        logger.info("[DIFY] query={}".format(query))
-        logger.debug(f"[DIFY] dify_user={user_id}")
-        session = self.sessions.get_session(session_id, user_id)
-        logger.debug(f"[DIFY] session_id={session_id} query={query}")
+        logger.info("[DIFY] query={}", query)
+        logger.debug("[DIFY] dify_user={}", user_id)
+        session = self.sessions.get_session(user_id)
+        logger.debug("[DIFY] session_id={} query={}", session_id, query)
 
         _reply_type_list, _reply_content_list = await self._reply(query, session)
         if _reply_type_list == []:
@@ -40,7 +44,7 @@ class DifyBot():
 
     def _get_payload(self, query, session: DifySession, response_mode):
         return {
-            'inputs': {},
+            'inputs': app_parameters.get_default_inputs(),
             "query": query,
             "response_mode": response_mode,
             "conversation_id": session.get_conversation_id(),
@@ -63,6 +67,10 @@ class DifyBot():
             else:
                 return [ReplyType.TEXT], ["dify_app_type must be agent, chatbot or workflow"]
 
+        except (DeadlineExceeded, httpx.TimeoutException, asyncio.TimeoutError) as e:
+            # 时间预算用完时返回兜底回复
+            logger.warning(f"[DIFY] request timed out: {e!r}")
+            return [ReplyType.TEXT], [config.dify_timeout_reply]
         except Exception as e:
             error_info = f"[DIFY] Exception: {e}"
             logger.exception(error_info)
@@ -78,29 +86,36 @@ class DifyBot():
         chat_client = ChatClient(api_key, api_base)
         response_mode = 'blocking'
         payload = self._get_payload(query, session, response_mode)
-        files = await self._get_upload_files(session)
+        with span("upload"):
+            files = await self._get_upload_files(session)
         # # response = requests.post(chat_url, headers=headers, json=payload)
         # async with httpx.AsyncClient() as client:
         #     logger.debug(f"Ready to connect {chat_url} with {payload}")
         #     response = await client.post(chat_url, headers=headers, json=payload, timeout=60)
-        response = await chat_client.create_chat_message(
-            inputs=payload['inputs'],
-            query=payload['query'],
-            user=payload['user'],
-            response_mode=payload['response_mode'],
-            conversation_id=payload['conversation_id'],
-            files=files
-        )
+        # httpx的超时只限制单次读写，整个请求另外受剩余预算约束
+        with span("dify_request", observe=True):
+            response = await asyncio.wait_for(
+                chat_client.create_chat_message(
+                    inputs=payload['inputs'],
+                    query=payload['query'],
+                    user=payload['user'],
+                    response_mode=payload['response_mode'],
+                    conversation_id=payload['conversation_id'],
+                    files=files
+                ),
+                remaining(),
+            )
         if response.status_code != 200:
             error_info = f"[DIFY] response text={response.text} status_code={response.status_code}"
             logger.warning(error_info)
             return [""], [error_info]
 
         rsp_data = response.json()
-        logger.debug("[DIFY] usage {}".format(rsp_data.get('metadata', {}).get('usage', 0)))
-
         answer = rsp_data['answer']
-        logger.debug(f"response data: {rsp_data}")
+        # 完整的响应较大，只在输出debug日志时格式化
+        if debug_enabled():
+            logger.debug("[DIFY] usage {}", rsp_data.get('metadata', {}).get('usage', 0))
+            logger.debug("response data: {}", rsp_data)
         parsed_content = parse_markdown_text(answer)
 
         replies_type = []
@@ -115,7 +130,8 @@ class DifyBot():
             elif item['type'] == 'file':
                 file_url = self._fill_file_base_url(item['content'])
                 # file_path = self._download_file(file_url)
-                replies_type.append(ReplyType.FILE)
+                # 只下载dify自身的文件，其他链接(网页、任意外部地址)仍作为文本发送
+                replies_type.append(ReplyType.FILE if self._is_dify_file_url(file_url) else ReplyType.TEXT)
                 replies_context.append(file_url)
             elif item['type'] == 'text':
                 content = item['content']
@@ -126,11 +142,9 @@ class DifyBot():
                 content = item['content']
                 replies_type.append(ReplyType.TEXT)
                 replies_context.append(content)
-            logger.debug(f"[DIFY] reply_item={replies_type[-1]}, {replies_context[-1]}")
+            logger.debug("[DIFY] reply_item={}, {}", replies_type[-1], replies_context[-1])
 
-        # 设置dify conversation_id, 依靠dify管理上下文
-        if session.get_conversation_id() == '':
-            session.set_conversation_id(rsp_data['conversation_id'])
+        self._update_session(session, rsp_data['conversation_id'], rsp_data.get('message_id'))
 
         return replies_type, replies_context
 
@@ -142,13 +156,17 @@ class DifyBot():
         response_mode = 'streaming'
         payload = self._get_payload(query, session, response_mode)
         # response = requests.post(chat_url, headers=headers, json=payload)
-        async with httpx.AsyncClient() as client:
-            response = await client.post(chat_url, headers=headers, json=payload, timeout=60)
+        with span("dify_request", observe=True):
+            async with httpx.AsyncClient() as client:
+                response = await asyncio.wait_for(
+                    client.post(chat_url, headers=headers, json=payload, timeout=stage_timeout("dify_request", 60)),
+                    remaining(),
+                )
         if response.status_code != 200:
             error_info = f"[DIFY] response text={response.text} status_code={response.status_code}"
             logger.warning(error_info)
             return [""], [error_info]
-        msgs, conversation_id = self._handle_sse_response(response)
+        msgs, conversation_id, message_id = self._handle_sse_response(response)
         
         replies_type = []
         replies_context = []
@@ -158,18 +176,23 @@ class DifyBot():
                 replies_type.append(ReplyType.TEXT)
                 replies_context.append(content)
             elif msg['type'] == 'message_file':
-                content = msg['content']['url']
-                replies_type.append(ReplyType.IMAGE_URL)
+                file_type = msg['content'].get('type')
+                content = self._fill_file_base_url(msg['content']['url'])
+                if file_type == 'image':
+                    replies_type.append(ReplyType.IMAGE_URL)
+                elif file_type == 'video':
+                    replies_type.append(ReplyType.VIDEO_URL)
+                else:
+                    replies_type.append(ReplyType.FILE)
                 replies_context.append(content)
             else:
                 logger.warning(f"[DIFY] Unknown type: {msg['type']}, content: {msg['content']}")
                 content = msg['content']
                 replies_type.append(ReplyType.IMAGE_URL)
                 replies_context.append(content)
-            logger.debug(f"[DIFY] reply_item={replies_type[-1]}, {replies_context[-1]}")
+            logger.debug("[DIFY] reply_item={}, {}", replies_type[-1], replies_context[-1])
 
-        if session.get_conversation_id() == '':
-            session.set_conversation_id(conversation_id)
+        self._update_session(session, conversation_id, message_id)
         return replies_type, replies_context
 
     async def _handle_workflow(self, query: str, session: DifySession):
@@ -178,8 +201,12 @@ class DifyBot():
         headers = self._get_headers()
         payload = self._get_workflow_payload(query, session)
         # response = requests.post(workflow_url, headers=headers, json=payload)
-        async with httpx.AsyncClient() as client:
-            response = await client.post(workflow_url, headers=headers, json=payload, timeout=60)
+        with span("dify_request", observe=True):
+            async with httpx.AsyncClient() as client:
+                response = await asyncio.wait_for(
+                    client.post(workflow_url, headers=headers, json=payload, timeout=stage_timeout("dify_request", 60)),
+                    remaining(),
+                )
         if response.status_code != 200:
             error_info = f"[DIFY] response text={response.text} status_code={response.status_code}"
             logger.warning(error_info)
@@ -194,14 +221,27 @@ class DifyBot():
         session_id = session.get_session_id()
         # logger.debug(f"Image cache: {memory.USER_IMAGE_CACHE}")
         img_cache = memory.USER_IMAGE_CACHE.get(session_id)
-        if not img_cache or not config.dify_image_upload_enable:
+        if not img_cache or not app_parameters.can_upload_image():
             return None
         api_key = config.dify_api_key
         api_base = config.dify_api_base
         dify_client = DifyClient(api_key, api_base)
         path = img_cache.get("path")
+        # 图片可能已被缓存清理淘汰
+        if not os.path.exists(path):
+            logger.warning(f"[DIFY] cached image {path} has been evicted.")
+            memory.USER_IMAGE_CACHE[session_id] = None
+            return None
+        memory.IMAGE_CACHE.touch(path)
+        # 上传前检查dify app的文件大小限制，超出则不上传
+        _reject_reason = app_parameters.check_image(os.path.getsize(path), os.path.basename(path))
+        if _reject_reason:
+            logger.warning(f"[DIFY] skip uploading {path}: {_reject_reason}")
+            memory.USER_IMAGE_CACHE[session_id] = None
+            memory.IMAGE_CACHE.remove(path)
+            return None
         with open(path, 'rb') as file:
-            logger.debug(f"Uploading file {path} to Dify.")
+            logger.debug("Uploading file {} to Dify.", path)
             file_name = os.path.basename(path)
             file_type, _ = mimetypes.guess_type(file_name)
             files = {
@@ -214,7 +254,7 @@ class DifyBot():
             # 清理图片缓存
             memory.USER_IMAGE_CACHE[session_id] = None
             # 清除图片
-            os.remove(path)
+            memory.IMAGE_CACHE.remove(path)
             error_info = f"[DIFY] response text={response.text} status_code={response.status_code} when upload file"
             logger.warning(error_info)
             return [""], [error_info]
@@ -222,10 +262,11 @@ class DifyBot():
         # 清理图片缓存
         memory.USER_IMAGE_CACHE[session_id] = None
         # 清除图片
-        os.remove(path)
+        memory.IMAGE_CACHE.remove(path)
 
         file_upload_data = response.json()
-        logger.debug("[DIFY] upload file {}".format(file_upload_data))
+        if debug_enabled():
+            logger.debug("[DIFY] upload file {}", file_upload_data)
         return [
             {
                 "type": "image",
@@ -234,6 +275,16 @@ class DifyBot():
             }
         ]
     
+    def _update_session(self, session: DifySession, conversation_id: str, message_id: str = None):
+        if message_id:
+            session.set_last_message_id(message_id)
+        # 设置dify conversation_id, 依靠dify管理上下文
+        if session.get_conversation_id() == '':
+            session.set_conversation_id(conversation_id)
+            # 会话命名不在回复链路上，交给后台队列
+            if config.dify_auto_rename_conversation:
+                submit_rename_conversation(conversation_id, session.get_user())
+
     def _fill_file_base_url(self, url: str):
         if url.startswith("https://") or url.startswith("http://"):
             return url
@@ -243,6 +294,9 @@ class DifyBot():
     def _get_file_base_url(self) -> str:
         return self._get_api_base_url().replace("/v1", "")
 
+    def _is_dify_file_url(self, url: str) -> bool:
+        return url.startswith(self._get_file_base_url().rstrip("/") + "/")
+
     def _get_workflow_payload(self, query, session: DifySession):
         return {
             'inputs': {
@@ -286,18 +340,22 @@ class DifyBot():
         merged_message = []
         accumulated_agent_message = ''
         conversation_id = None
+        message_id = None
         for event in events:
             event_name = event['event']
+            message_id = event.get('message_id') or message_id
             if event_name == 'agent_message' or event_name == 'message':
                 accumulated_agent_message += event['answer']
-                logger.debug("[DIFY] accumulated_agent_message: {}".format(accumulated_agent_message))
+                if debug_enabled():
+                    logger.debug("[DIFY] accumulated_agent_message: {}", accumulated_agent_message)
                 # 保存conversation_id
                 if not conversation_id:
                     conversation_id = event['conversation_id']
             elif event_name == 'agent_thought':
                 self._append_agent_message(accumulated_agent_message, merged_message)
                 accumulated_agent_message = ''
-                logger.debug("[DIFY] agent_thought: {}".format(event))
+                if debug_enabled():
+                    logger.debug("[DIFY] agent_thought: {}", event)
             elif event_name == 'message_file':
                 self._append_agent_message(accumulated_agent_message, merged_message)
                 accumulated_agent_message = ''
@@ -310,7 +368,8 @@ class DifyBot():
                 raise Exception(event)
             elif event_name == 'message_end':
                 self._append_agent_message(accumulated_agent_message, merged_message)
-                logger.debug("[DIFY] message_end usage: {}".format(event['metadata']['usage']))
+                if debug_enabled():
+                    logger.debug("[DIFY] message_end usage: {}", event['metadata']['usage'])
                 break
             else:
                 logger.warning("[DIFY] unknown event: {}".format(event))
@@ -318,7 +377,7 @@ class DifyBot():
         if not conversation_id:
             raise Exception("conversation_id not found")
         
-        return merged_message, conversation_id
+        return merged_message, conversation_id, message_id
 
     def _append_agent_message(self, accumulated_agent_message,  merged_message):
         if accumulated_agent_message:
@@ -328,8 +387,6 @@ class DifyBot():
             })
 
     def _append_message_file(self, event: dict, merged_message: list):
-        if event.get('type') != 'image':
-            logger.warning("[DIFY] unsupported message file type: {}".format(event))
         merged_message.append({
             'type': 'message_file',
             'content': event,
@@ -1,5 +1,9 @@
+import time
+
 import httpx
 
+from .common.deadline import stage_latency, stage_timeout
+
 
 class DifyClient:
     def __init__(self, api_key, base_url: str = 'https://api.dify.ai/v1'):
@@ -13,13 +17,15 @@ class DifyClient:
         }
 
         url = f"{self.base_url}{endpoint}"
+        # 超时时间受当前消息的剩余预算约束
+        timeout = stage_timeout("dify_request", 50)
 
         async with httpx.AsyncClient() as client:
             if stream:
-                async with client.stream(method, url, json=json, params=params, headers=headers, timeout=50) as response:
+                async with client.stream(method, url, json=json, params=params, headers=headers, timeout=timeout) as response:
                     return response
             else:
-                response = await client.request(method, url, json=json, params=params, headers=headers, timeout=50)
+                response = await client.request(method, url, json=json, params=params, headers=headers, timeout=timeout)
                 return response
 
     async def _send_request_with_files(self, method, endpoint, data, files):
@@ -28,8 +34,12 @@ class DifyClient:
         }
 
         url = f"{self.base_url}{endpoint}"
+        timeout = stage_timeout("upload", 30)
         async with httpx.AsyncClient() as client:
-            response = await client.request(method, url, data=data, headers=headers, files=files, timeout=30)
+            start_time = time.perf_counter()
+            response = await client.request(method, url, data=data, headers=headers, files=files, timeout=timeout)
+            # 只记录实际完成的上传耗时，用于自适应超时
+            stage_latency.observe("upload", time.perf_counter() - start_time)
 
         return response
 
@@ -94,6 +104,6 @@ class ChatClient(DifyClient):
         params = {"user": user, "last_id": last_id, "limit": limit, "pinned": pinned}
         return await self._send_request("GET", "/conversations", params=params)
 
-    async def rename_conversation(self, conversation_id, name, user):
-        data = {"name": name, "user": user}
+    async def rename_conversation(self, conversation_id, name, user, auto_generate=False):
+        data = {"name": name, "user": user, "auto_generate": auto_generate}
         return await self._send_request("POST", f"/conversations/{conversation_id}/name", data)
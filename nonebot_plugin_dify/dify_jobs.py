@@ -0,0 +1,55 @@
+from .config import config
+from .dify_client import DifyClient, ChatClient
+from .common.job_queue import JobQueue, PermanentJobError
+
+
+def _check_response(response):
+    # 除429外的4xx重试也不会成功，例如会话已删除(404)、参数错误(400)
+    if 400 <= response.status_code < 500 and response.status_code != 429:
+        raise PermanentJobError(f"status_code={response.status_code} text={response.text}")
+    response.raise_for_status()
+
+
+async def _message_feedback(payload: dict):
+    dify_client = DifyClient(config.dify_api_key, config.dify_api_base)
+    response = await dify_client.message_feedback(payload["message_id"], payload["rating"], payload["user"])
+    _check_response(response)
+
+
+async def _rename_conversation(payload: dict):
+    chat_client = ChatClient(config.dify_api_key, config.dify_api_base)
+    response = await chat_client.rename_conversation(
+        payload["conversation_id"], payload.get("name", ""), payload["user"], auto_generate=not payload.get("name")
+    )
+    _check_response(response)
+
+
+# 不在回复链路上的dify API调用，统一交给后台队列
+job_queue = JobQueue(
+    {
+        "message_feedback": _message_feedback,
+        "rename_conversation": _rename_conversation,
+    },
+    maxsize=config.dify_job_queue_size,
+    workers=config.dify_job_workers,
+    rate_limit=config.dify_job_rate_limit,
+    max_retries=config.dify_job_max_retries,
+)
+
+
+def submit_message_feedback(message_id: str, rating: str, user: str) -> bool:
+    """rating为like/dislike，同一条消息多次反馈只保留最后一次"""
+    return job_queue.submit(
+        "message_feedback",
+        {"message_id": message_id, "rating": rating, "user": user},
+        key=message_id,
+    )
+
+
+def submit_rename_conversation(conversation_id: str, user: str, name: str = "") -> bool:
+    """name为空时由dify自动生成会话名"""
+    return job_queue.submit(
+        "rename_conversation",
+        {"conversation_id": conversation_id, "name": name, "user": user},
+        key=conversation_id,
+    )
@@ -0,0 +1,132 @@
+import asyncio
+import mimetypes
+from typing import Dict, List, Optional
+
+from nonebot import logger
+
+from .config import config
+from .dify_client import DifyClient
+
+
+# 获取应用参数时使用的固定用户标识
+PARAMETERS_USER = "nonebot-plugin-dify"
+
+
+class DifyAppParameters(object):
+    """
+    dify app参数缓存，启动后在后台获取，之后定时刷新，不阻塞启动。
+
+    未成功获取参数前`loaded`为False，此时所有判断都放行，行为与未接入参数前一致。
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self.image_upload_enabled = True
+        self.image_transfer_methods: List[str] = []
+        self.image_file_size_limit = 0
+        self.user_input_form: List[Dict] = []
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def update(self, data: dict):
+        file_upload = data.get("file_upload") or {}
+        image = file_upload.get("image") or {}
+        system_parameters = data.get("system_parameters") or {}
+
+        # 旧版本dify只有`file_upload.image`，新版本增加了`file_upload.enabled`和`allowed_file_types`
+        if "enabled" in file_upload:
+            allowed_file_types = file_upload.get("allowed_file_types") or []
+            self.image_upload_enabled = bool(file_upload["enabled"]) and (
+                not allowed_file_types or "image" in allowed_file_types
+            )
+        else:
+            self.image_upload_enabled = bool(image.get("enabled", False))
+        self.image_transfer_methods = (
+            image.get("transfer_methods") or file_upload.get("allowed_file_upload_methods") or []
+        )
+        # dify返回的大小限制单位为MB
+        self.image_file_size_limit = int(system_parameters.get("image_file_size_limit") or 0) * 1024 * 1024
+        self.user_input_form = data.get("user_input_form") or []
+        self.loaded = True
+
+    def can_upload_image(self) -> bool:
+        """插件配置和dify app配置都允许时才上传图片"""
+        if not config.dify_image_upload_enable:
+            return False
+        if not self.loaded:
+            return True
+        if not self.image_upload_enabled:
+            return False
+        if self.image_transfer_methods and "local_file" not in self.image_transfer_methods:
+            return False
+        return True
+
+    def check_image(self, size: int, filename: str = "", mimetype: Optional[str] = None) -> Optional[str]:
+        """
+        检查图片是否满足dify app的上传限制，满足返回None，否则返回原因
+        """
+        if not self.loaded:
+            return None
+        if self.image_file_size_limit and size > self.image_file_size_limit:
+            return f"image size {size} exceeds limit {self.image_file_size_limit}"
+        if mimetype is None and filename:
+            mimetype, _ = mimetypes.guess_type(filename)
+        if mimetype and not mimetype.startswith("image/"):
+            return f"mimetype {mimetype} is not an image"
+        return None
+
+    def get_default_inputs(self) -> Dict:
+        """
+        根据`user_input_form`生成带默认值的inputs
+
+        user_input_form示例: [{"text-input": {"label": "...", "variable": "name", "required": true, "default": ""}}]
+        """
+        inputs = {}
+        for item in self.user_input_form:
+            for form in item.values():
+                if not isinstance(form, dict):
+                    continue
+                variable = form.get("variable")
+                default = form.get("default")
+                if variable and default not in (None, ""):
+                    inputs[variable] = default
+        return inputs
+
+    async def fetch(self) -> bool:
+        dify_client = DifyClient(config.dify_api_key, config.dify_api_base)
+        try:
+            response = await dify_client.get_application_parameters(PARAMETERS_USER)
+            if response.status_code != 200:
+                logger.warning(
+                    f"[DIFY] get parameters failed, response text={response.text} status_code={response.status_code}"
+                )
+                return False
+            self.update(response.json())
+        except Exception as e:
+            logger.warning(f"[DIFY] get parameters failed: {e}")
+            return False
+        logger.debug(
+            f"[DIFY] app parameters loaded, image_upload_enabled={self.image_upload_enabled}, "
+            f"image_file_size_limit={self.image_file_size_limit}"
+        )
+        return True
+
+    async def _refresh_loop(self, interval: int):
+        # dify不可达时首次获取可能耗时较长，放在后台执行，获取成功前所有判断放行
+        await self.fetch()
+        if interval <= 0:
+            return
+        while True:
+            await asyncio.sleep(interval)
+            await self.fetch()
+
+    async def start(self):
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_loop(config.dify_parameters_refresh_interval))
+
+    async def stop(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+
+
+app_parameters = DifyAppParameters()
@@ -1,66 +1,140 @@
-from .common.expired_dict import ExpiredDict
+import sys
+import time
+import uuid
+from typing import Dict, Optional, Union
+
 from .config import config
-from nonebot import logger
+from .common.trace import logger
+
+
+def _pack_uuid(value: str) -> Union[bytes, str]:
+    """dify的conversation_id/message_id为uuid，保存为16字节的bytes，无法解析时原样保存"""
+    if not value:
+        return b''
+    try:
+        return uuid.UUID(value).bytes
+    except ValueError:
+        return value
+
+
+def _unpack_uuid(value: Union[bytes, str]) -> str:
+    if isinstance(value, bytes):
+        return str(uuid.UUID(bytes=value)) if value else ''
+    return value
 
 
 class DifySession(object):
-    def __init__(self, session_id: str, user: str, conversation_id: str=''):
-        self.__session_id = session_id
-        self.__user = user
-        self.__conversation_id = conversation_id
-        self.__user_message_counter = 0
+    """
+    单个用户的会话，使用__slots__避免每个实例的__dict__。
+
+    session_id由user推导，不单独保存；conversation_id以16字节保存；
+    过期时间以整数秒保存在会话上，不再额外包装为(value, datetime)元组。
+    """
+
+    __slots__ = ("_user", "_conversation_id", "_last_message_id", "_user_message_counter", "expiry_time")
+
+    def __init__(self, user: str, conversation_id: str=''):
+        self._user = user
+        self._conversation_id = _pack_uuid(conversation_id)
+        self._last_message_id = b''
+        self._user_message_counter = 0
+        self.expiry_time = 0
 
     def get_session_id(self):
-        return self.__session_id
+        return f"s-{self._user}"
 
     def get_user(self):
-        return self.__user
+        return self._user
 
     def get_conversation_id(self):
-        return self.__conversation_id
+        return _unpack_uuid(self._conversation_id)
 
     def set_conversation_id(self, conversation_id):
-        self.__conversation_id = conversation_id
+        self._conversation_id = _pack_uuid(conversation_id)
+
+    def get_last_message_id(self):
+        """最近一条dify回复的message_id，用于消息反馈"""
+        return _unpack_uuid(self._last_message_id)
+
+    def set_last_message_id(self, message_id):
+        self._last_message_id = _pack_uuid(message_id)
 
     def count_user_message(self):
-        if self.__user_message_counter >= config.dify_convsersation_max_messages:
-            self.__user_message_counter = 0
+        if self._user_message_counter >= config.dify_convsersation_max_messages:
+            self._user_message_counter = 0
             # FIXME: dify目前不支持设置历史消息长度，暂时使用超过5条清空会话的策略，缺点是没有滑动窗口，会突然丢失历史消息
-            self.__conversation_id = ''
-        
-        self.__user_message_counter += 1
+            self._conversation_id = b''
+
+        self._user_message_counter += 1
 
 
 class DifySessionManager(object):
+    # 新建的会话数达到max(PURGE_EVERY, 当前会话数)时清理一次过期会话，
+    # 清理需要遍历所有会话，间隔随会话数增长，均摊到每次新建为O(1)
+    PURGE_EVERY = 1024
+
     def __init__(self, sessioncls, **session_kwargs):
-        if config.dify_expires_in_seconds:
-            sessions = ExpiredDict(config.dify_expires_in_seconds)
-        else:
-            sessions = dict()
-        self.sessions = sessions
+        # key为intern后的user，与session中保存的user共用同一个字符串对象
+        self.sessions: Dict[str, DifySession] = dict()
+        self.expires_in_seconds = config.dify_expires_in_seconds
         self.sessioncls = sessioncls
         self.session_kwargs = session_kwargs
+        self._created_since_purge = 0
+
+    def _now(self) -> int:
+        return int(time.monotonic())
 
-    def _build_session(self, session_id: str, user: str):
+    def _build_session(self, user: str):
         """
-        如果session_id不在sessions中，创建一个新的session并添加到sessions中
+        如果user不在sessions中或已过期，创建一个新的session并添加到sessions中
         """
-        if session_id not in self.sessions:
-            logger.debug(f"session_id {session_id} not in self.sessions, setting new session.")
-            self.sessions[session_id] = self.sessioncls(session_id, user)
-        session = self.sessions[session_id]
-        logger.debug(f"Got session_id {session_id}.")
+        now = self._now()
+        session: Optional[DifySession] = self.sessions.get(user)
+        if session is not None and self.expires_in_seconds and session.expiry_time < now:
+            logger.debug("session of {} expired.", user)
+            session = None
+        if session is None:
+            logger.debug("user {} not in self.sessions, setting new session.", user)
+            user = sys.intern(user)
+            session = self.sessioncls(user, **self.session_kwargs)
+            self.sessions[user] = session
+            self._created_since_purge += 1
+        if self.expires_in_seconds:
+            session.expiry_time = now + self.expires_in_seconds
+        if self._created_since_purge >= max(self.PURGE_EVERY, len(self.sessions)):
+            self.purge_expired()
         return session
 
-    def get_session(self, session_id, user):
-        session = self._build_session(session_id, user)
+    def get_session(self, user: str):
+        session = self._build_session(user)
         return session
 
-    def clear_session(self, session_id):
-        if session_id in self.sessions:
-            logger.debug(f"clear session {session_id}")
-            del self.sessions[session_id]
+    def find_session(self, user: str) -> Optional[DifySession]:
+        """只查找未过期的session，不新建"""
+        session = self.sessions.get(user)
+        if session is not None and self.expires_in_seconds and session.expiry_time < self._now():
+            return None
+        return session
+
+    def purge_expired(self):
+        self._created_since_purge = 0
+        if not self.expires_in_seconds:
+            return
+        now = self._now()
+        expired = [user for user, session in self.sessions.items() if session.expiry_time < now]
+        for user in expired:
+            del self.sessions[user]
+        if expired:
+            logger.debug(f"purged {len(expired)} expired sessions")
+
+    def clear_session(self, user: str):
+        if user in self.sessions:
+            logger.debug(f"clear session of {user}")
+            del self.sessions[user]
 
     def clear_all_session(self):
         logger.debug(f"clear all sessions")
-        self.sessions.clear()
\ No newline at end of file
+        self.sessions.clear()
+
+    def __len__(self):
+        return len(self.sessions)